@@ -0,0 +1,169 @@
+import argparse
+import multiprocessing
+import os
+import tempfile
+import zipfile
+import numpy as np
+import psycopg2
+from joblib import Parallel, delayed
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+DIJKSTRA_CHUNK_SIZE = 256
+
+def main(host, dbname, user, password, index_path, max_distance):
+    connection_string = "host={0} dbname={1} user={2} password={3}".format(host, dbname, user, password)
+    conn = psycopg2.connect(connection_string)
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    print("Building network index...")
+    build_network_index(cur, index_path, max_distance, get_network_version(cur))
+
+# returns an index for the current network that answers node distances up to at least max_distance, rebuilding it if needed
+def get_network_index(cur, index_path, max_distance):
+    version = get_network_version(cur)
+
+    if os.path.exists(index_path):
+        try:
+            index = load_network_index(index_path)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            print("Network index is unreadable, rebuilding: {0}".format(e))
+            index = None
+
+        if index is not None:
+            if index["version"] == version and index["max_distance"] >= max_distance:
+                return index
+
+            max_distance = max(max_distance, index["max_distance"])
+
+    return build_network_index(cur, index_path, max_distance, version)
+
+def get_network_version(cur):
+    cur.execute("""
+        SELECT md5(string_agg(edge_id || ':' || start_node || ':' || end_node || ':' || ST_Length(geom), ',' ORDER BY edge_id))
+        FROM network_topo.edge_data
+    """)
+    return cur.fetchone()[0]
+
+def load_network_index(index_path):
+    with np.load(index_path) as data:
+        index = {key: data[key] for key in data.files}
+
+    index["version"] = str(index["version"])
+    index["max_distance"] = float(index["max_distance"])
+    index["distances"] = csr_matrix((index.pop("distances_data"), index.pop("distances_indices"), index.pop("distances_indptr")),
+                                    shape=(len(index["node_ids"]), len(index["node_ids"])))
+
+    # sorted row * num_nodes + col keys of the stored entries, so lookups can tell a stored zero from a missing pair
+    distances = index["distances"]
+    distances.sort_indices()
+    rows = np.repeat(np.arange(distances.shape[0], dtype=np.int64), np.diff(distances.indptr))
+    index["distance_keys"] = rows * distances.shape[1] + distances.indices.astype(np.int64)
+    return index
+
+# dijkstra returns a dense row per source node, so sources are solved in small chunks and kept as sparse triplets
+def compute_node_distances_bucket(graph, node_indices, max_distance):
+    node_indices = np.asarray(node_indices, dtype=int)
+    sources, targets, distances = [np.array([], dtype=int)], [np.array([], dtype=int)], [np.array([])]
+
+    for start in range(0, len(node_indices), DIJKSTRA_CHUNK_SIZE):
+        chunk = node_indices[start:start + DIJKSTRA_CHUNK_SIZE]
+        chunk_distances = dijkstra(graph, directed=False, indices=chunk, limit=max_distance)
+        rows, cols = np.nonzero(np.isfinite(chunk_distances))
+
+        sources.append(chunk[rows])
+        targets.append(cols)
+        distances.append(chunk_distances[rows, cols])
+
+    return np.concatenate(sources), np.concatenate(targets), np.concatenate(distances)
+
+def build_network_index(cur, index_path, max_distance, version):
+    cur.execute("SELECT edge_id, start_node, end_node, ST_Length(geom) FROM network_topo.edge_data ORDER BY edge_id")
+    rows = cur.fetchall()
+
+    edge_ids = np.array([row[0] for row in rows], dtype=int)
+    edge_lengths = np.array([row[3] for row in rows], dtype=float)
+    node_ids, node_indices = np.unique(np.array([[row[1], row[2]] for row in rows], dtype=int), return_inverse=True)
+    node_indices = node_indices.reshape(-1, 2)
+    edge_starts = node_indices[:, 0]
+    edge_ends = node_indices[:, 1]
+
+    # keep only the shortest of parallel edges, since duplicates would be summed by the sparse matrix
+    order = np.lexsort((edge_lengths, np.maximum(edge_starts, edge_ends), np.minimum(edge_starts, edge_ends)))
+    sources = np.minimum(edge_starts, edge_ends)[order]
+    targets = np.maximum(edge_starts, edge_ends)[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])
+    graph = coo_matrix((edge_lengths[order][first], (sources[first], targets[first])), shape=(len(node_ids), len(node_ids))).tocsr()
+
+    buckets = [[] for i in range(multiprocessing.cpu_count())]
+    for node_index in range(len(node_ids)):
+        buckets[node_index % len(buckets)].append(node_index)
+
+    results = Parallel(n_jobs=-1)(delayed(compute_node_distances_bucket)(graph, buckets[i], max_distance) for i in range(len(buckets)))
+
+    distances = coo_matrix((np.concatenate([result[2] for result in results]),
+                            (np.concatenate([result[0] for result in results]), np.concatenate([result[1] for result in results]))),
+                           shape=(len(node_ids), len(node_ids))).tocsr()
+
+    # written next to the index and moved into place, so an interrupted build never leaves a truncated index behind
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(index_path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez_compressed(f, version=version, max_distance=max_distance, node_ids=node_ids, edge_ids=edge_ids,
+                                edge_starts=edge_starts, edge_ends=edge_ends, edge_lengths=edge_lengths,
+                                distances_data=distances.data, distances_indices=distances.indices, distances_indptr=distances.indptr)
+        os.replace(temp_path, index_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    return load_network_index(index_path)
+
+# node pairs missing from the index are further apart than its max_distance
+def lookup_node_distances(index, sources, targets):
+    keys = sources.astype(np.int64) * index["distances"].shape[1] + targets.astype(np.int64)
+    positions = np.minimum(np.searchsorted(index["distance_keys"], keys), len(index["distance_keys"]) - 1)
+
+    distances = np.full(len(keys), np.inf)
+    if len(index["distance_keys"]) > 0:
+        found = index["distance_keys"][positions] == keys
+        distances[found] = index["distances"].data[positions[found]]
+
+    distances[sources == targets] = 0
+    return distances
+
+# network distance between points given by a base edge and an offset along it from the edge's start node
+def compute_point_distances(index, edges_a, offsets_a, edges_b, offsets_b):
+    positions_a = np.searchsorted(index["edge_ids"], edges_a)
+    positions_b = np.searchsorted(index["edge_ids"], edges_b)
+
+    ends_a = [(index["edge_starts"][positions_a], offsets_a), (index["edge_ends"][positions_a], index["edge_lengths"][positions_a] - offsets_a)]
+    ends_b = [(index["edge_starts"][positions_b], offsets_b), (index["edge_ends"][positions_b], index["edge_lengths"][positions_b] - offsets_b)]
+
+    distances = np.where(edges_a == edges_b, np.abs(offsets_a - offsets_b), np.inf)
+    for nodes_a, to_node_a in ends_a:
+        for nodes_b, to_node_b in ends_b:
+            distances = np.minimum(distances, to_node_a + lookup_node_distances(index, nodes_a, nodes_b) + to_node_b)
+
+    return distances
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-host", required=True, dest="host",
+                        help="psql host")
+    parser.add_argument("-d", required=True, dest="dbname",
+                        help="psql database")
+    parser.add_argument("-u", required=True, dest="user",
+                        help="psql user")
+    parser.add_argument("-p", required=True, dest="password",
+                        help="psql password")
+    parser.add_argument("-i", required=True, dest="index_path",
+                        help="network index file")
+    parser.add_argument("-md", type=float, required=True, dest="max_distance",
+                        help="largest search bandwidth the index should answer")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    main(**vars(parse_arguments()))
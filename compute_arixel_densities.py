@@ -1,11 +1,12 @@
 import argparse
+import calendar
 import multiprocessing
 import psycopg2
 from psycopg2 import sql
 from psycopg2.extras import execute_values
 from joblib import Parallel, delayed
 
-def main(host, dbname, user, password, lixel_length, space_search_bandwidth, time_search_bandwidth, time_type, date_field, srid):
+def main(host, dbname, user, password, lixel_length, space_search_bandwidth, time_search_bandwidth, time_type, date_field, srid, summary):
     connection_string = "host={0} dbname={1} user={2} password={3}".format(host, dbname, user, password)
     conn = psycopg2.connect(connection_string)
     conn.autocommit = True
@@ -21,40 +22,91 @@ def main(host, dbname, user, password, lixel_length, space_search_bandwidth, tim
     compute_arixel_densities(cur, connection_string, time_type, lixel_length, space_search_bandwidth, time_search_bandwidth)
 
     print("Creating arixels table...")
-    compute_arixels(cur, lixel_length, space_search_bandwidth, time_search_bandwidth, time_type, srid)
+    compute_arixels(cur, lixel_length, space_search_bandwidth, time_search_bandwidth, time_type, srid, summary)
 
-def compute_arixels(cur, lixel_length, space_search_bandwidth, time_search_bandwidth, time_type, srid):
+def compute_arixels(cur, lixel_length, space_search_bandwidth, time_search_bandwidth, time_type, srid, summary):
     time_type_string = get_time_type_string(time_type)
     table_name = "arixels_{0}_{1}_{2}_{3}".format(lixel_length, time_type_string, space_search_bandwidth, time_search_bandwidth)
 
     cur.execute(sql.SQL("""
         CREATE TABLE {0} (
             time_id int NOT NULL,
+            time_label text NOT NULL,
             edge_id int NOT NULL,
             geom geometry(LineString, %(srid)s) NOT NULL,
             count int NOT NULL,
             density double precision NOT NULL,
             height int NOT NULL,
             PRIMARY KEY (time_id, edge_id))
+        PARTITION BY LIST (time_id)
     """).format(sql.Identifier(table_name)), {"srid": srid})
 
     densities_table_name = "arixel_{0}_{1}_{2}_{3}_densities".format(lixel_length, time_type_string, space_search_bandwidth, time_search_bandwidth)
     network_topo_schema = "network_topo_{0}".format(lixel_length)
     count_table_name = "arixel_{0}_{1}_count".format(lixel_length, time_type_string)
 
+    cur.execute(sql.SQL("""SELECT id, value FROM {0} ORDER BY id""").format(sql.Identifier(get_time_type_table(time_type))))
+
+    # height stacks time bins in order for 3D display, instead of scaling the opaque serial time_id
+    for position, (time_id, value) in enumerate(cur.fetchall()):
+        partition_name = "{0}_{1}".format(table_name, time_id)
+
+        cur.execute(sql.SQL("""
+            CREATE TABLE {0} PARTITION OF {1} FOR VALUES IN (%(time_id)s);
+            CREATE INDEX {2} ON {0} USING gist (geom);
+            CREATE INDEX {3} ON {0} (edge_id);
+        """).format(sql.Identifier(partition_name), sql.Identifier(table_name), sql.Identifier(partition_name + "_spatial_index"),
+                   sql.Identifier(partition_name + "_edge_index")),
+            {"time_id": time_id})
+
+        cur.execute(sql.SQL("""
+            INSERT INTO {0}
+            (SELECT d.time_id, %(time_label)s, d.edge_id, ed.geom,
+                c.count,
+                CASE
+                    WHEN d.density IS NULL THEN 0::double precision
+                    ELSE d.density
+                END AS density,
+                %(height)s
+            FROM {1}.edge_data as ed
+                INNER JOIN {2} as d ON d.edge_id = ed.edge_id
+                INNER JOIN {3} as c ON c.edge_id = d.edge_id and c.time_id = d.time_id
+            WHERE d.time_id = %(time_id)s)
+        """).format(sql.Identifier(partition_name), sql.Identifier(network_topo_schema), sql.Identifier(densities_table_name), sql.Identifier(count_table_name)),
+            {"time_id": time_id, "time_label": get_time_label(time_type, value), "height": position * 10})
+
+    cur.execute("SELECT pg_notify('density_tables', %s)", (table_name,))
+
+    if summary:
+        compute_arixels_summary(cur, table_name, srid)
+
+def compute_arixels_summary(cur, table_name, srid):
+    summary_table_name = "{0}_summary".format(table_name)
+
+    cur.execute(sql.SQL("""
+        CREATE TABLE {0} (
+            edge_id int NOT NULL,
+            geom geometry(LineString, %(srid)s) NOT NULL,
+            total_count int NOT NULL,
+            total_density double precision NOT NULL,
+            peak_time_id int NOT NULL,
+            peak_time_label text NOT NULL,
+            peak_density double precision NOT NULL,
+            PRIMARY KEY (edge_id));
+        CREATE INDEX {1} ON {0} USING gist (geom);
+    """).format(sql.Identifier(summary_table_name), sql.Identifier(summary_table_name + "_spatial_index")), {"srid": srid})
+
     cur.execute(sql.SQL("""
         INSERT INTO {0}
-        (SELECT d.time_id, d.edge_id, ed.geom, 
-            c.count,
-            CASE 
-                WHEN d.density IS NULL THEN 0::double precision 
-                ELSE d.density 
-            END AS density, 
-            d.time_id * 10 
-        FROM {1}.edge_data as ed 
-            INNER JOIN {2} as d ON d.edge_id = ed.edge_id
-            INNER JOIN {3} as c ON c.edge_id = d.edge_id and c.time_id = d.time_id)
-    """).format(sql.Identifier(table_name), sql.Identifier(network_topo_schema), sql.Identifier(densities_table_name), sql.Identifier(count_table_name)))
+        SELECT DISTINCT ON (edge_id) edge_id, geom,
+            SUM(count) OVER (PARTITION BY edge_id),
+            SUM(density) OVER (PARTITION BY edge_id),
+            time_id, time_label, density
+        FROM {1}
+        ORDER BY edge_id, density DESC, time_id
+    """).format(sql.Identifier(summary_table_name), sql.Identifier(table_name)))
+
+    cur.execute("SELECT pg_notify('density_tables', %s)", (summary_table_name,))
 
 def generate_time_type_table(cur, time_type, date_field):
     time_type_field = get_time_type_field(time_type)
@@ -288,6 +340,20 @@ def get_time_type_string(time_type):
     elif time_type == "y":
         return "by_year"
 
+def get_time_label(time_type, value):
+    if time_type == "dw":
+        return calendar.day_name[(value - 1) % 7]
+    elif time_type == "h":
+        return "{0:02d}:00".format(value)
+    elif time_type == "w":
+        return "Week {0}".format(value)
+    elif time_type == "m":
+        return calendar.month_name[value]
+    elif time_type == "s":
+        return "Q{0}".format(value)
+    elif time_type == "y":
+        return str(value)
+
 def is_cyclic(time_type):
     return time_type in ["dw", "h", "w", "m", "s"]
 
@@ -313,6 +379,8 @@ def parse_arguments():
                         help="Time grouping: day of week (dw), hour of day (h), week (w), month (m), season (s), year (y)")
     parser.add_argument("-df", required=True, dest="date_field",
                         help="Date field of events table")
+    parser.add_argument("-summary", action="store_true", dest="summary",
+                        help="also create a per-edge summary table with total and peak densities")
     return parser.parse_args()
 
 if __name__ == "__main__":
@@ -0,0 +1,164 @@
+import argparse
+import numpy as np
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+from scipy.sparse import coo_matrix
+from compute_arixel_densities import (compute_density, compute_neighbour_time_ids, compute_time_distance, get_time_type_string,
+                                      get_time_type_table, is_cyclic, quartic_curve, validate_time_type)
+from compute_lixel_significance import compute_exceedances, load_lixels
+
+def main(host, dbname, user, password, lixel_length, space_search_bandwidth, time_search_bandwidth, time_type, simulations, significance_level, shuffle_times, seed):
+    connection_string = "host={0} dbname={1} user={2} password={3}".format(host, dbname, user, password)
+    conn = psycopg2.connect(connection_string)
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    print("Loading arixels...")
+    edge_ids, lengths = load_lixels(cur, lixel_length)
+    edge_indices = {edge_id: i for i, edge_id in enumerate(edge_ids)}
+    time_ids = load_time_ids(cur, time_type)
+    counts = load_arixel_counts(cur, lixel_length, time_type, edge_indices, time_ids)
+
+    print("Building kernel matrices...")
+    time_masks = build_time_masks(time_ids, time_search_bandwidth, is_cyclic(time_type))
+    kernels = build_kernel_matrices(cur, lixel_length, space_search_bandwidth, time_search_bandwidth, edge_indices, time_masks)
+    self_weight = compute_density(0, 0, 1, space_search_bandwidth, time_search_bandwidth, quartic_curve)
+    observed = compute_arixel_density_matrix(kernels, self_weight, counts)
+
+    print("Running simulations...")
+    exceedances = compute_exceedances(simulate_arixel_bucket, (kernels, self_weight, counts, lengths / lengths.sum(), observed, shuffle_times), simulations, seed)
+    p_values = (exceedances + 1) / (simulations + 1)
+
+    print("Creating significance table...")
+    compute_arixel_significance(cur, lixel_length, space_search_bandwidth, time_search_bandwidth, time_type, edge_ids, time_ids, observed, p_values, significance_level)
+
+def load_time_ids(cur, time_type):
+    cur.execute(sql.SQL("SELECT id FROM {0} ORDER BY id").format(sql.Identifier(get_time_type_table(time_type))))
+    return [row[0] for row in cur.fetchall()]
+
+def load_arixel_counts(cur, lixel_length, time_type, edge_indices, time_ids):
+    count_table_name = "arixel_{0}_{1}_count".format(lixel_length, get_time_type_string(time_type))
+    cur.execute(sql.SQL("SELECT time_id, edge_id, count FROM {0} WHERE count > 0").format(sql.Identifier(count_table_name)))
+
+    counts = np.zeros((len(edge_indices), len(time_ids)), dtype=int)
+    for time_id, edge_id, count in cur.fetchall():
+        counts[edge_indices[edge_id], time_ids.index(time_id)] = count
+
+    return counts
+
+# time_masks[k][i, j] is 1 when time bin j is a neighbour of time bin i at time distance k
+def build_time_masks(time_ids, time_search_bandwidth, cyclic):
+    time_masks = {}
+
+    for i, time_id in enumerate(time_ids):
+        for neighbour_time_id in compute_neighbour_time_ids(time_ids, time_id, time_search_bandwidth, cyclic):
+            time_distance = compute_time_distance(time_ids, time_id, neighbour_time_id, cyclic)
+            if time_distance not in time_masks:
+                time_masks[time_distance] = np.zeros((len(time_ids), len(time_ids)))
+            time_masks[time_distance][i, time_ids.index(neighbour_time_id)] = 1
+
+    return time_masks
+
+# pairs each time mask with a matrix whose [i, j] entry is the density an event on lixel i adds to neighbouring lixel j at that time distance
+def build_kernel_matrices(cur, lixel_length, space_search_bandwidth, time_search_bandwidth, edge_indices, time_masks):
+    lixel_distance_table_name = "lixel_{0}_{1}_distances".format(lixel_length, space_search_bandwidth)
+    cur.execute(sql.SQL("SELECT source_edge, target_edge, distance FROM {0}").format(sql.Identifier(lixel_distance_table_name)))
+    rows = cur.fetchall()
+
+    sources = np.array([edge_indices[row[0]] for row in rows], dtype=int)
+    targets = np.array([edge_indices[row[1]] for row in rows], dtype=int)
+    distances = np.array([row[2] for row in rows], dtype=float)
+
+    row_indices = np.concatenate([sources, targets])
+    col_indices = np.concatenate([targets, sources])
+
+    kernels = []
+    for time_distance, time_mask in time_masks.items():
+        weights = np.broadcast_to(compute_density(distances, time_distance, 1, space_search_bandwidth, time_search_bandwidth, quartic_curve), distances.shape)
+        data = np.concatenate([weights, weights])
+        space_kernel = coo_matrix((data, (row_indices, col_indices)), shape=(len(edge_indices), len(edge_indices))).tocsr()
+        kernels.append((space_kernel, time_mask))
+
+    return kernels
+
+def compute_arixel_density_matrix(kernels, self_weight, counts):
+    densities = self_weight * counts
+    for space_kernel, time_mask in kernels:
+        densities = densities + (space_kernel.T @ counts) @ time_mask
+
+    return densities
+
+def simulate_arixel_bucket(kernels, self_weight, counts, probabilities, observed, shuffle_times, simulations, seed):
+    rng = np.random.default_rng(seed)
+    exceedances = np.zeros(observed.shape, dtype=int)
+
+    num_edges, num_times = counts.shape
+    event_edges, event_times = np.nonzero(counts)
+    event_counts = counts[event_edges, event_times]
+    event_edges = np.repeat(event_edges, event_counts)
+    event_times = np.repeat(event_times, event_counts)
+    time_totals = counts.sum(axis=0)
+
+    for _ in range(simulations):
+        if shuffle_times:
+            shuffled_times = rng.permutation(event_times)
+            simulated_counts = np.bincount(event_edges * num_times + shuffled_times, minlength=num_edges * num_times).reshape(num_edges, num_times)
+        else:
+            simulated_counts = rng.multinomial(time_totals, probabilities).T
+
+        densities = compute_arixel_density_matrix(kernels, self_weight, simulated_counts)
+        exceedances += densities >= observed
+
+    return exceedances
+
+def compute_arixel_significance(cur, lixel_length, space_search_bandwidth, time_search_bandwidth, time_type, edge_ids, time_ids, observed, p_values, significance_level):
+    time_type_string = get_time_type_string(time_type)
+    table_name = "arixel_{0}_{1}_{2}_{3}_significance".format(lixel_length, time_type_string, space_search_bandwidth, time_search_bandwidth)
+
+    cur.execute(sql.SQL("""
+        CREATE TABLE {0} (
+        time_id integer NOT NULL,
+        edge_id integer NOT NULL,
+        density double precision NOT NULL,
+        p_value double precision NOT NULL,
+        hotspot boolean NOT NULL,
+        PRIMARY KEY (time_id, edge_id))
+    """).format(sql.Identifier(table_name)))
+
+    edge_indices, time_indices = np.nonzero(observed)
+    values = [(time_ids[j], edge_ids[i], float(observed[i, j]), float(p_values[i, j]), bool(p_values[i, j] <= significance_level))
+              for i, j in zip(edge_indices, time_indices)]
+    query = "INSERT INTO {0} VALUES %s".format(table_name)
+    execute_values(cur, query, values)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-host", required=True, dest="host",
+                        help="psql host")
+    parser.add_argument("-d", required=True, dest="dbname",
+                        help="psql database")
+    parser.add_argument("-u", required=True, dest="user",
+                        help="psql user")
+    parser.add_argument("-p", required=True, dest="password",
+                        help="psql password")
+    parser.add_argument("-l", type=int, required=True, dest="lixel_length",
+                        help="lixel length")
+    parser.add_argument("-ssb", type=int, required=True, dest="space_search_bandwidth",
+                        help="space search bandwidth")
+    parser.add_argument("-tsb", type=int, required=True, dest="time_search_bandwidth",
+                        help="time search bandwidth")
+    parser.add_argument("-t", type=validate_time_type, required=True, dest="time_type",
+                        help="Time grouping: day of week (dw), hour of day (h), week (w), month (m), season (s), year (y)")
+    parser.add_argument("-n", type=int, default=999, dest="simulations",
+                        help="number of monte carlo simulations")
+    parser.add_argument("-a", type=float, default=0.05, dest="significance_level",
+                        help="p-value at or below which an arixel is flagged as a hotspot")
+    parser.add_argument("-st", action="store_true", dest="shuffle_times",
+                        help="shuffle event times between events instead of randomizing event locations")
+    parser.add_argument("-seed", type=int, default=None, dest="seed",
+                        help="random seed")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    main(**vars(parse_arguments()))
@@ -1,9 +1,14 @@
 import argparse
 import psycopg2
 import multiprocessing
+import numpy as np
+from psycopg2.extras import execute_values
 from joblib import Parallel, delayed
+from build_network_index import compute_point_distances, get_network_index
 
-def main(host, dbname, user, password, lixel_length, srid, search_bandwidth):
+DISTANCE_BATCH_SIZE = 1000000
+
+def main(host, dbname, user, password, lixel_length, srid, search_bandwidth, index_path):
     connection_string = "host={0} dbname={1} user={2} password={3}".format(host, dbname, user, password)
     conn = psycopg2.connect(connection_string)
     conn.autocommit = True
@@ -16,7 +21,10 @@ def main(host, dbname, user, password, lixel_length, srid, search_bandwidth):
     compute_lixel_counts(cur, lixel_length)
 
     print("Computing lixel distances...")
-    compute_lixel_distances(cur, connection_string, lixel_length, search_bandwidth)
+    if index_path is None:
+        compute_lixel_distances(cur, connection_string, lixel_length, search_bandwidth)
+    else:
+        compute_lixel_distances_with_index(cur, lixel_length, search_bandwidth, index_path)
 
     cur.execute("DROP TABLE lixel_%(lixel_length)s_midpoints", {"lixel_length": lixel_length})
 
@@ -41,7 +49,7 @@ def compute_lixel_distances_bucket(connection_string, bucket, lixel_length, sear
     cur.close()
     conn.close()
 
-def compute_lixel_distances(cur, connection_string, lixel_length, search_bandwidth):
+def create_lixel_distances_table(cur, lixel_length, search_bandwidth):
     cur.execute("""
         CREATE TABLE public.lixel_%(lixel_length)s_%(search_bandwidth)s_distances(
         id serial NOT NULL,
@@ -52,6 +60,9 @@ def compute_lixel_distances(cur, connection_string, lixel_length, search_bandwid
         CONSTRAINT lixel_%(lixel_length)s_%(search_bandwidth)s_distances_source_target_unique_constraint UNIQUE (source_edge, target_edge))
     """, {"lixel_length": lixel_length, "search_bandwidth": search_bandwidth})
 
+def compute_lixel_distances(cur, connection_string, lixel_length, search_bandwidth):
+    create_lixel_distances_table(cur, lixel_length, search_bandwidth)
+
     cur.execute("SELECT edge_id FROM lixel_%s_count", (lixel_length,))
     rows = cur.fetchall()
 
@@ -61,6 +72,51 @@ def compute_lixel_distances(cur, connection_string, lixel_length, search_bandwid
 
     Parallel(n_jobs=-1)(delayed(compute_lixel_distances_bucket)(connection_string, buckets[i], lixel_length, search_bandwidth) for i in range(len(buckets)))
 
+# lixel midpoints are located on the base network edges so distances can be answered from the network index
+def compute_lixel_distances_with_index(cur, lixel_length, search_bandwidth, index_path):
+    create_lixel_distances_table(cur, lixel_length, search_bandwidth)
+
+    print("Loading network index...")
+    index = get_network_index(cur, index_path, search_bandwidth)
+
+    cur.execute("""
+        SELECT m.edge_id, b.edge_id, ST_LineLocatePoint(b.geom, m.midpoint) * ST_Length(b.geom)
+        FROM lixel_%(lixel_length)s_midpoints as m
+            CROSS JOIN LATERAL (SELECT edge_id, geom FROM network_topo.edge_data ORDER BY geom <-> m.midpoint LIMIT 1) as b
+    """, {"lixel_length": lixel_length})
+    base_edges = {}
+    offsets = {}
+    for edge_id, base_edge_id, offset in cur.fetchall():
+        base_edges[edge_id] = base_edge_id
+        offsets[edge_id] = offset
+
+    # network distance is never shorter than straight line distance, so only nearby midpoints need to be checked
+    cur.execute("""
+        SELECT e1.edge_id, e2.edge_id FROM lixel_%(lixel_length)s_midpoints as e1
+            INNER JOIN lixel_%(lixel_length)s_midpoints as e2
+            ON e1.edge_id < e2.edge_id AND ST_DWithin(e1.midpoint, e2.midpoint, %(search_bandwidth)s)
+        WHERE e1.edge_id IN (SELECT edge_id FROM lixel_%(lixel_length)s_count)
+            OR e2.edge_id IN (SELECT edge_id FROM lixel_%(lixel_length)s_count)
+    """, {"lixel_length": lixel_length, "search_bandwidth": search_bandwidth})
+    pairs = np.array(cur.fetchall(), dtype=int).reshape(-1, 2)
+
+    query = "INSERT INTO lixel_{0}_{1}_distances (source_edge, target_edge, distance) VALUES %s ON CONFLICT (source_edge, target_edge) DO NOTHING".format(lixel_length, search_bandwidth)
+
+    for start in range(0, len(pairs), DISTANCE_BATCH_SIZE):
+        sources = pairs[start:start + DISTANCE_BATCH_SIZE, 0]
+        targets = pairs[start:start + DISTANCE_BATCH_SIZE, 1]
+
+        distances = compute_point_distances(index,
+                                            np.array([base_edges[edge_id] for edge_id in sources], dtype=int),
+                                            np.array([offsets[edge_id] for edge_id in sources], dtype=float),
+                                            np.array([base_edges[edge_id] for edge_id in targets], dtype=int),
+                                            np.array([offsets[edge_id] for edge_id in targets], dtype=float))
+
+        within_bandwidth = distances <= search_bandwidth
+        values = [(int(source), int(target), float(distance)) for source, target, distance in
+                  zip(sources[within_bandwidth], targets[within_bandwidth], distances[within_bandwidth])]
+        execute_values(cur, query, values)
+
 def generate_midpoints(cur, lixel_length, srid):
     cur.execute("""
     CREATE TABLE public.lixel_%(lixel_length)s_midpoints(
@@ -116,6 +172,8 @@ def parse_arguments():
                         help="srid")
     parser.add_argument("-sb", type=int, required=True, dest="search_bandwidth",
                         help="search bandwidth")
+    parser.add_argument("-i", default=None, dest="index_path",
+                        help="network index file, built or rebuilt when missing or out of date")
     return parser.parse_args()
 
 if __name__ == "__main__":
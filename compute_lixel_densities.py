@@ -44,6 +44,8 @@ def compute_lixels(cur, lixel_length, search_bandwidth, srid):
                 LEFT JOIN lixel_%(lixel_length)s_%(search_bandwidth)s_densities ld ON ld.id = ed.edge_id;
     """, {"lixel_length": lixel_length, "search_bandwidth": search_bandwidth})
 
+    cur.execute("SELECT pg_notify('density_tables', 'lixels_%(lixel_length)s_%(search_bandwidth)s')", {"lixel_length": lixel_length, "search_bandwidth": search_bandwidth})
+
 def compute_lixel_densities_bucket(connection_string, bucket, lixel_length, search_bandwidth):
     conn = psycopg2.connect(connection_string)
     conn.autocommit = True
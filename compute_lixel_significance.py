@@ -0,0 +1,130 @@
+import argparse
+import multiprocessing
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+from joblib import Parallel, delayed
+from scipy.sparse import coo_matrix
+from compute_lixel_densities import compute_density, quartic_curve
+
+SIMULATION_BATCH_SIZE = 32
+
+def main(host, dbname, user, password, lixel_length, search_bandwidth, simulations, significance_level, seed):
+    connection_string = "host={0} dbname={1} user={2} password={3}".format(host, dbname, user, password)
+    conn = psycopg2.connect(connection_string)
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    print("Loading lixels...")
+    edge_ids, lengths = load_lixels(cur, lixel_length)
+    edge_indices = {edge_id: i for i, edge_id in enumerate(edge_ids)}
+    counts = load_lixel_counts(cur, lixel_length, edge_indices)
+
+    print("Building kernel matrix...")
+    kernel = build_kernel_matrix(cur, lixel_length, search_bandwidth, edge_indices)
+    observed = kernel.T @ counts
+
+    print("Running simulations...")
+    exceedances = compute_exceedances(simulate_lixel_bucket, (kernel, lengths / lengths.sum(), int(counts.sum()), observed), simulations, seed)
+    p_values = (exceedances + 1) / (simulations + 1)
+
+    print("Creating significance table...")
+    compute_lixel_significance(cur, lixel_length, search_bandwidth, edge_ids, observed, p_values, significance_level)
+
+def load_lixels(cur, lixel_length):
+    cur.execute("SELECT edge_id, ST_Length(geom) FROM network_topo_%s.edge_data ORDER BY edge_id", (lixel_length,))
+    rows = cur.fetchall()
+
+    return [row[0] for row in rows], np.array([row[1] for row in rows], dtype=float)
+
+def load_lixel_counts(cur, lixel_length, edge_indices):
+    cur.execute("SELECT edge_id, count FROM lixel_%s_count WHERE count > 0", (lixel_length,))
+
+    counts = np.zeros(len(edge_indices))
+    for edge_id, count in cur.fetchall():
+        counts[edge_indices[edge_id]] = count
+
+    return counts
+
+# kernel[i, j] is the density an event on lixel i adds to lixel j, so densities are kernel.T @ counts
+def build_kernel_matrix(cur, lixel_length, search_bandwidth, edge_indices):
+    cur.execute("""
+        SELECT source_edge, target_edge, distance FROM lixel_%(lixel_length)s_%(search_bandwidth)s_distances
+    """, {"lixel_length": lixel_length, "search_bandwidth": search_bandwidth})
+    rows = cur.fetchall()
+
+    sources = np.array([edge_indices[row[0]] for row in rows], dtype=int)
+    targets = np.array([edge_indices[row[1]] for row in rows], dtype=int)
+    distances = np.array([row[2] for row in rows], dtype=float)
+    diagonal = np.arange(len(edge_indices))
+
+    weights = compute_density(distances, 1, search_bandwidth, quartic_curve)
+    self_weight = compute_density(0, 1, search_bandwidth, quartic_curve)
+
+    data = np.concatenate([weights, weights, np.full(len(diagonal), self_weight)])
+    row_indices = np.concatenate([sources, targets, diagonal])
+    col_indices = np.concatenate([targets, sources, diagonal])
+
+    return coo_matrix((data, (row_indices, col_indices)), shape=(len(edge_indices), len(edge_indices))).tocsr()
+
+def simulate_lixel_bucket(kernel, probabilities, num_events, observed, simulations, seed):
+    rng = np.random.default_rng(seed)
+    exceedances = np.zeros(len(observed), dtype=int)
+
+    for start in range(0, simulations, SIMULATION_BATCH_SIZE):
+        batch_size = min(SIMULATION_BATCH_SIZE, simulations - start)
+        counts = rng.multinomial(num_events, probabilities, size=batch_size)
+        densities = kernel.T @ counts.T
+        exceedances += (densities >= observed[:, np.newaxis]).sum(axis=1)
+
+    return exceedances
+
+# splits the simulations across cores, calling simulate_bucket(*args, simulations, seed) once per bucket
+def compute_exceedances(simulate_bucket, args, simulations, seed):
+    buckets = [simulations // multiprocessing.cpu_count()] * multiprocessing.cpu_count()
+    for i in range(simulations % len(buckets)):
+        buckets[i] += 1
+
+    seeds = np.random.SeedSequence(seed).spawn(len(buckets))
+
+    exceedances_list = Parallel(n_jobs=-1)(delayed(simulate_bucket)(*args, buckets[i], seeds[i]) for i in range(len(buckets)))
+    return np.sum(exceedances_list, axis=0)
+
+def compute_lixel_significance(cur, lixel_length, search_bandwidth, edge_ids, observed, p_values, significance_level):
+    cur.execute("""
+        CREATE TABLE public.lixel_%(lixel_length)s_%(search_bandwidth)s_significance (
+        edge_id integer NOT NULL,
+        density double precision NOT NULL,
+        p_value double precision NOT NULL,
+        hotspot boolean NOT NULL,
+        CONSTRAINT lixel_%(lixel_length)s_%(search_bandwidth)s_significance_pkey PRIMARY KEY (edge_id))
+    """, {"lixel_length": lixel_length, "search_bandwidth": search_bandwidth})
+
+    values = [(edge_id, float(observed[i]), float(p_values[i]), bool(p_values[i] <= significance_level)) for i, edge_id in enumerate(edge_ids)]
+    query = "INSERT INTO lixel_{0}_{1}_significance VALUES %s".format(lixel_length, search_bandwidth)
+    execute_values(cur, query, values)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-host", required=True, dest="host",
+                        help="psql host")
+    parser.add_argument("-d", required=True, dest="dbname",
+                        help="psql database")
+    parser.add_argument("-u", required=True, dest="user",
+                        help="psql user")
+    parser.add_argument("-p", required=True, dest="password",
+                        help="psql password")
+    parser.add_argument("-l", type=int, required=True, dest="lixel_length",
+                        help="lixel length")
+    parser.add_argument("-sb", type=int, required=True, dest="search_bandwidth",
+                        help="search bandwidth")
+    parser.add_argument("-n", type=int, default=999, dest="simulations",
+                        help="number of monte carlo simulations")
+    parser.add_argument("-a", type=float, default=0.05, dest="significance_level",
+                        help="p-value at or below which a lixel is flagged as a hotspot")
+    parser.add_argument("-seed", type=int, default=None, dest="seed",
+                        help="random seed")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    main(**vars(parse_arguments()))
@@ -0,0 +1,439 @@
+import argparse
+import json
+import queue
+import re
+import select
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import psycopg2
+import psycopg2.errors
+from psycopg2 import sql
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+NOTIFY_CHANNEL = "density_tables"
+TILES_SCHEMA = "tiles"
+EARTH_CIRCUMFERENCE = 40075016.686
+TILE_SIZE = 256
+MAX_CONNECTIONS = 8
+CONNECTION_TIMEOUT = 10
+GENERALIZE_TIMEOUT = 30
+RETRY_DELAY = 5
+MAX_RETRY_DELAY = 300
+MVT_EXTENT = 4096
+MVT_BUFFER = 64
+
+# matches lixels and arixels tables and arixel summaries, but not the per time bin arixel partitions
+TABLE_NAME_PATTERN = re.compile(r"^(lixels_\d+_\d+|arixels_\d+_by_[a-z_]+_\d+_\d+(_summary)?)$")
+TILE_PATH_PATTERN = re.compile(r"^/tiles/([a-z0-9_]+)/(\d+)/(\d+)/(\d+)\.pbf$")
+SERIES_PATH_PATTERN = re.compile(r"^/series/([a-z0-9_]+)/(\d+)$")
+
+class NotFoundError(Exception):
+    pass
+
+class UnavailableError(Exception):
+    pass
+
+class TileCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # keys are tuples of the form (kind, table_name, ...)
+    def invalidate(self, table_name):
+        with self.lock:
+            for key in [key for key in self.entries if key[1] == table_name]:
+                del self.entries[key]
+
+# generation is bumped on every rebuild so results queried before the rebuild are never cached
+class TableState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.generalized = threading.Event()
+        self.failures = 0
+
+class TileServer(ThreadingHTTPServer):
+    def __init__(self, address, pool, cache, min_zoom, max_zoom):
+        super().__init__(address, TileRequestHandler)
+        self.pool = pool
+        self.connection_slots = threading.BoundedSemaphore(MAX_CONNECTIONS)
+        self.cache = cache
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.tables = {}
+        self.tables_lock = threading.Lock()
+        self.generalize_queue = queue.Queue()
+
+    def get_table_state(self, table_name):
+        with self.tables_lock:
+            if table_name not in self.tables:
+                self.tables[table_name] = TableState()
+                self.generalize_queue.put(table_name)
+            return self.tables[table_name]
+
+    def invalidate(self, table_name):
+        with self.tables_lock:
+            if table_name not in self.tables:
+                self.tables[table_name] = TableState()
+            state = self.tables[table_name]
+
+        with state.lock:
+            state.generation += 1
+            state.generalized.clear()
+
+        self.cache.invalidate(table_name)
+        self.generalize_queue.put(table_name)
+
+    def cache_if_current(self, state, generation, key, value):
+        with state.lock:
+            if state.generation == generation:
+                self.cache.put(key, value)
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+
+        tile_match = TILE_PATH_PATTERN.match(url.path)
+        series_match = SERIES_PATH_PATTERN.match(url.path)
+
+        try:
+            if tile_match:
+                table_name, z, x, y = tile_match.group(1), int(tile_match.group(2)), int(tile_match.group(3)), int(tile_match.group(4))
+                time_id = int(params["time_id"][0]) if "time_id" in params else None
+                self.send_tile(table_name, z, x, y, time_id)
+            elif series_match:
+                self.send_series(series_match.group(1), int(series_match.group(2)))
+            else:
+                self.send_error(404)
+        except NotFoundError as e:
+            self.send_error(404, str(e))
+        except ValueError as e:
+            self.send_error(400, str(e))
+        except (UnavailableError, PoolError) as e:
+            self.send_error(503, str(e))
+        except psycopg2.errors.UndefinedTable:
+            self.send_error(404)
+        except psycopg2.Error as e:
+            self.log_error("database error: %s", str(e).strip())
+            self.send_error(500)
+
+    def send_tile(self, table_name, z, x, y, time_id):
+        validate_table_name(table_name)
+
+        if z < self.server.min_zoom:
+            raise NotFoundError("tiles are only served from zoom {0}".format(self.server.min_zoom))
+
+        if x >= 2 ** z or y >= 2 ** z:
+            raise ValueError("tile {0}/{1}/{2} is out of range".format(z, x, y))
+
+        if is_time_sliced(table_name) and time_id is None:
+            raise ValueError("time_id is required for arixel tiles")
+
+        if not is_time_sliced(table_name):
+            time_id = None
+
+        key = ("tile", table_name, z, x, y, time_id)
+        tile = self.server.cache.get(key)
+
+        if tile is None:
+            state = self.get_table_state(table_name)
+            with state.lock:
+                generation = state.generation
+
+            if not state.generalized.wait(GENERALIZE_TIMEOUT):
+                raise UnavailableError("{0} is still being generalized".format(table_name))
+
+            # a rebuild between reading the generation and the wait ending means the generalized copy may be half built
+            with state.lock:
+                if state.generation != generation or not state.generalized.is_set():
+                    raise UnavailableError("{0} is being rebuilt".format(table_name))
+
+            tile = self.with_cursor(lambda cur: query_tile(cur, table_name, z, x, y, time_id, self.server.max_zoom))
+            self.server.cache_if_current(state, generation, key, tile)
+
+        self.send_body(tile, "application/vnd.mapbox-vector-tile")
+
+    def send_series(self, table_name, edge_id):
+        validate_table_name(table_name)
+
+        if not is_time_sliced(table_name):
+            raise ValueError("time series are only available for arixel tables")
+
+        key = ("series", table_name, edge_id)
+        series = self.server.cache.get(key)
+
+        if series is None:
+            state = self.get_table_state(table_name)
+            with state.lock:
+                generation = state.generation
+            series = self.with_cursor(lambda cur: query_series(cur, table_name, edge_id))
+            self.server.cache_if_current(state, generation, key, series)
+
+        self.send_body(series, "application/json")
+
+    def get_table_state(self, table_name):
+        if not self.with_cursor(lambda cur: table_exists(cur, table_name)):
+            raise NotFoundError("{0} does not exist".format(table_name))
+
+        return self.server.get_table_state(table_name)
+
+    # the semaphore makes requests wait for a free connection instead of failing when the pool is exhausted
+    def with_cursor(self, query):
+        if not self.server.connection_slots.acquire(timeout=CONNECTION_TIMEOUT):
+            raise UnavailableError("no database connection available")
+
+        try:
+            conn = self.server.pool.getconn()
+            broken = False
+            try:
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    return query(cur)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = True
+                raise
+            finally:
+                self.server.pool.putconn(conn, close=broken)
+        finally:
+            self.server.connection_slots.release()
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(body)
+
+def main(host, dbname, user, password, port, min_zoom, max_zoom, cache_size):
+    connection_string = "host={0} dbname={1} user={2} password={3}".format(host, dbname, user, password)
+    pool = ThreadedConnectionPool(1, MAX_CONNECTIONS, connection_string)
+
+    server = TileServer(("", port), pool, TileCache(cache_size), min_zoom, max_zoom)
+
+    conn = psycopg2.connect(connection_string)
+    cur = conn.cursor()
+    cur.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'public'")
+    for row in cur.fetchall():
+        if TABLE_NAME_PATTERN.match(row[0]):
+            server.get_table_state(row[0])
+    conn.close()
+
+    generalizer = threading.Thread(target=generalize_tables, args=(connection_string, server), daemon=True)
+    generalizer.start()
+
+    listener = threading.Thread(target=listen_for_rebuilds, args=(connection_string, server), daemon=True)
+    listener.start()
+
+    print("Serving tiles on port {0}...".format(port))
+    server.serve_forever()
+
+# density scripts send a notification with the table name whenever an output table is rebuilt
+def listen_for_rebuilds(connection_string, server):
+    failures = 0
+    conn = None
+
+    while True:
+        try:
+            conn = psycopg2.connect(connection_string)
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute(sql.SQL("LISTEN {0}").format(sql.Identifier(NOTIFY_CHANNEL)))
+
+            # notifications sent while disconnected are lost, so everything known may be stale
+            if failures > 0:
+                with server.tables_lock:
+                    table_names = list(server.tables)
+                for table_name in table_names:
+                    server.invalidate(table_name)
+            failures = 0
+
+            while True:
+                if select.select([conn], [], [], 5) == ([], [], []):
+                    continue
+
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    if not TABLE_NAME_PATTERN.match(notify.payload):
+                        continue
+
+                    print("Invalidating {0}...".format(notify.payload))
+                    server.invalidate(notify.payload)
+        except (psycopg2.Error, OSError) as e:
+            print("Lost rebuild notifications connection: {0}".format(str(e).strip()))
+            if conn is not None:
+                conn.close()
+            time.sleep(get_retry_delay(failures))
+            failures += 1
+
+# tables are generalized one at a time off the request path, as they are found at startup or rebuilt
+def generalize_tables(connection_string, server):
+    conn = None
+
+    while True:
+        table_name = server.generalize_queue.get()
+
+        with server.tables_lock:
+            state = server.tables[table_name]
+
+        if state.generalized.is_set():
+            continue
+
+        with state.lock:
+            generation = state.generation
+        print("Generalizing {0}...".format(table_name))
+
+        try:
+            if conn is None or conn.closed:
+                conn = psycopg2.connect(connection_string)
+                conn.autocommit = True
+
+            with conn.cursor() as cur:
+                generalize_table(cur, table_name, server.min_zoom, server.max_zoom)
+        except psycopg2.errors.UndefinedTable:
+            # the table was dropped for a rebuild, its notification will queue it again
+            continue
+        except psycopg2.Error as e:
+            if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)) and conn is not None:
+                conn.close()
+
+            delay = get_retry_delay(state.failures)
+            state.failures += 1
+            print("Could not generalize {0}, retrying in {1}s: {2}".format(table_name, delay, str(e).strip()))
+
+            retry = threading.Timer(delay, server.generalize_queue.put, args=(table_name,))
+            retry.daemon = True
+            retry.start()
+            continue
+
+        with state.lock:
+            state.failures = 0
+            if state.generation == generation:
+                state.generalized.set()
+
+def get_retry_delay(failures):
+    return min(RETRY_DELAY * 2 ** failures, MAX_RETRY_DELAY)
+
+# time sliced arixels are joined back on their partition by (time_id, edge_id), every other table is read from its generalized copy
+def query_tile(cur, table_name, z, x, y, time_id, max_zoom):
+    zoom = min(z, max_zoom)
+
+    if is_time_sliced(table_name):
+        columns = sql.SQL(", ").join(sql.Identifier("t", column) for column in get_tile_columns(table_name))
+        source = sql.SQL("INNER JOIN public.{0} as t ON t.time_id = %(time_id)s AND t.edge_id = g.edge_id").format(sql.Identifier(table_name))
+    else:
+        columns = sql.SQL(", ").join(sql.Identifier("g", column) for column in get_tile_columns(table_name))
+        source = sql.SQL("")
+
+    cur.execute(sql.SQL("""
+        SELECT ST_AsMVT(q, %(layer)s, %(extent)s, 'geom') FROM
+            (SELECT {2},
+                ST_AsMVTGeom(g.geom, ST_TileEnvelope(%(z)s, %(x)s, %(y)s), %(extent)s, %(buffer)s, true) as geom
+            FROM {0}.{1} as g {3}
+            WHERE g.zoom = %(zoom)s AND g.geom && ST_TileEnvelope(%(z)s, %(x)s, %(y)s, margin => %(margin)s)) as q
+    """).format(sql.Identifier(TILES_SCHEMA), sql.Identifier(table_name), columns, source),
+        {"layer": table_name, "z": z, "x": x, "y": y, "zoom": zoom, "time_id": time_id,
+         "extent": MVT_EXTENT, "buffer": MVT_BUFFER, "margin": MVT_BUFFER / MVT_EXTENT})
+
+    tile = cur.fetchone()[0]
+    return bytes(tile) if tile is not None else b""
+
+def query_series(cur, table_name, edge_id):
+    cur.execute(sql.SQL("""
+        SELECT time_id, time_label, count, density FROM public.{0} WHERE edge_id = %(edge_id)s ORDER BY time_id
+    """).format(sql.Identifier(table_name)), {"edge_id": edge_id})
+
+    series = [{"time_id": row[0], "time_label": row[1], "count": row[2], "density": row[3]} for row in cur.fetchall()]
+    return json.dumps({"edge_id": edge_id, "series": series}).encode("utf-8")
+
+# geometry is simplified once per zoom level into tiles.<table_name> so tile queries never touch full resolution geometry,
+# tables with one row per edge also get their attributes copied so their tiles never touch the public table at all
+def generalize_table(cur, table_name, min_zoom, max_zoom):
+    if is_time_sliced(table_name):
+        columns = sql.SQL("")
+    else:
+        columns = sql.SQL("").join(sql.SQL(", e.{0}").format(sql.Identifier(column)) for column in get_tile_columns(table_name) if column != "edge_id")
+
+    zoom_tolerances = sql.SQL(", ").join(
+        sql.SQL("({0}, {1})").format(sql.Literal(zoom), sql.Literal(get_zoom_tolerance(zoom)))
+        for zoom in range(min_zoom, max_zoom + 1))
+
+    cur.execute(sql.SQL("""
+        CREATE SCHEMA IF NOT EXISTS {0};
+        DROP TABLE IF EXISTS {0}.{1};
+        CREATE TABLE {0}.{1} AS
+            SELECT z.zoom, e.edge_id, ST_SimplifyPreserveTopology(ST_Transform(e.geom, 3857), z.tolerance) as geom{3}
+            FROM (SELECT DISTINCT ON (edge_id) * FROM public.{1}) as e
+                CROSS JOIN (VALUES {2}) as z(zoom, tolerance);
+        CREATE INDEX ON {0}.{1} USING gist (geom);
+        CREATE INDEX ON {0}.{1} (zoom);
+    """).format(sql.Identifier(TILES_SCHEMA), sql.Identifier(table_name), zoom_tolerances, columns))
+
+# half a pixel at the given zoom level, in web mercator meters
+def get_zoom_tolerance(zoom):
+    return EARTH_CIRCUMFERENCE / (TILE_SIZE * 2 ** zoom) / 2
+
+def is_time_sliced(table_name):
+    return table_name.startswith("arixels_") and not table_name.endswith("_summary")
+
+def get_tile_columns(table_name):
+    if table_name.endswith("_summary"):
+        columns = ["edge_id", "total_count", "total_density", "peak_time_id", "peak_time_label", "peak_density"]
+    elif is_time_sliced(table_name):
+        columns = ["edge_id", "time_id", "time_label", "count", "density"]
+    else:
+        columns = ["edge_id", "count", "density"]
+
+    return columns
+
+def validate_table_name(table_name):
+    if not TABLE_NAME_PATTERN.match(table_name):
+        raise ValueError("{0} is not a lixels or arixels table".format(table_name))
+
+# only public tables count, the generalized copies in the tiles schema share their names
+def table_exists(cur, table_name):
+    cur.execute("SELECT to_regclass('public.' || %s) IS NOT NULL", (table_name,))
+    return cur.fetchone()[0]
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-host", required=True, dest="host",
+                        help="psql host")
+    parser.add_argument("-d", required=True, dest="dbname",
+                        help="psql database")
+    parser.add_argument("-u", required=True, dest="user",
+                        help="psql user")
+    parser.add_argument("-p", required=True, dest="password",
+                        help="psql password")
+    parser.add_argument("-port", type=int, default=8080, dest="port",
+                        help="http port")
+    parser.add_argument("-minz", type=int, default=10, dest="min_zoom",
+                        help="lowest zoom level tiles are served at")
+    parser.add_argument("-maxz", type=int, default=18, dest="max_zoom",
+                        help="highest zoom level with its own generalized geometry")
+    parser.add_argument("-c", type=int, default=10000, dest="cache_size",
+                        help="number of tiles and time series kept in the cache")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    main(**vars(parse_arguments()))